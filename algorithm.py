@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 """Run NMF algorithms and print evaluation metrics"""
 import argparse
-from collections import Counter
+from contextlib import nullcontext
 from csv import DictReader, DictWriter
 from itertools import product
+from multiprocessing import get_context
 import os
 from pathlib import Path
 from sys import stdin, stdout
-from typing import Callable, List, TextIO, Tuple
+from typing import Callable, List, Optional, TextIO, Tuple
 import matplotlib.pyplot as plt
 import numpy as np
 from PIL import Image
+try:
+    import faiss
+except ImportError:  # faiss is optional, only needed for --clusterer faiss.
+    faiss = None
+try:
+    import cupy
+except ImportError:  # cupy is optional, only needed for the cuda backend.
+    cupy = None
 from sklearn.cluster import KMeans
 from sklearn.metrics import accuracy_score, normalized_mutual_info_score
 from sklearn.model_selection import train_test_split
+from threadpoolctl import threadpool_limits
 
 
 def load_data(root: str = 'data/CroppedYaleB',
@@ -24,8 +34,20 @@ def load_data(root: str = 'data/CroppedYaleB',
     Args:
         root: path to dataset.
         reduce: scale factor for zooming out images.
+
+    Images are returned as raw 8-bit pixels (one column per image) and are
+    cached next to the dataset as .npy files, memory-mapped on later runs.
+    The cache is skipped if it cannot be written.
     """
-    images, labels = [], []
+    # Tagged with the resize filter so caches of other pixels are not reused.
+    cache = f'{root}.r{reduce}.box'
+
+    if (os.path.exists(f'{cache}.images.npy')
+            and os.path.exists(f'{cache}.labels.npy')):
+        return (np.load(f'{cache}.images.npy', mmap_mode='r'),
+                np.load(f'{cache}.labels.npy'))
+
+    files, labels = [], []
 
     for i, person in enumerate(sorted(os.listdir(root))):
 
@@ -41,37 +63,75 @@ def load_data(root: str = 'data/CroppedYaleB',
             if not fname.endswith('.pgm'):
                 continue
 
-            # load image.
-            img = Image.open(os.path.join(root, person, fname))
-            img = img.convert('L')  # grey image.
+            # collect file and label.
+            files.append(os.path.join(root, person, fname))
+            labels.append(i)
 
-            # reduce computation complexity.
-            img = img.resize([s // reduce for s in img.size])
+    if not files:
+        raise ValueError(f'no .pgm images found in {root}')
 
-            # convert image to numpy array.
-            img = np.asarray(img).reshape((-1, 1)) / SCALE
+    images = None
 
-            # collect data and label.
-            images.append(img)
-            labels.append(i)
+    for j, path in enumerate(files):
+        # load image.
+        img = Image.open(path)
+        size = tuple(s // reduce for s in img.size)
+        img = img.convert('L')  # grey image.
+
+        # reduce computation complexity (box filter for downscaling).
+        img = img.resize(size, Image.BOX)
+
+        # fill the column of a matrix sized by the file scan.
+        if images is None:
+            images = np.empty((size[0] * size[1], len(files)), dtype=np.uint8)
+
+        images[:, j] = np.frombuffer(img.tobytes(), dtype=np.uint8)
 
-    # concate all images and labels.
-    images = np.concatenate(images, axis=1)
     labels = np.array(labels)
+    save_cache(f'{cache}.images.npy', images)
+    save_cache(f'{cache}.labels.npy', labels)
 
     return images, labels
 
 
-def assign_cluster_label(X: np.ndarray, Y: np.ndarray) -> np.ndarray:
+def save_cache(path: str, array: np.ndarray) -> None:
+    """Atomically write an .npy cache file, ignoring unwritable locations"""
+    tmp = f'{path}.{os.getpid()}.tmp'
+
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+
+        os.replace(tmp, path)
+    except OSError:
+        # Read-only data directory: run without the cache.
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def assign_cluster_label(X: np.ndarray,
+                         Y: np.ndarray,
+                         n_clusters: int,
+                         clusterer: str = 'sklearn') -> np.ndarray:
     """Label the data according to clustering, for evaluation"""
-    kmeans = KMeans(n_clusters=len(set(Y))).fit(X)
-    Y_pred = np.zeros(Y.shape)
+    if clusterer == 'sklearn':
+        labels = KMeans(n_clusters=n_clusters).fit(X).labels_
+    elif clusterer == 'faiss':
+        if faiss is None:
+            raise ImportError('faiss is required for the faiss clusterer')
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        kmeans = faiss.Kmeans(X.shape[1], n_clusters, niter=20, seed=0)
+        kmeans.train(X)
+        labels = kmeans.index.search(X, 1)[1].ravel()
+    else:
+        raise ValueError(f'unknown clusterer: {clusterer}')
 
-    for i in set(kmeans.labels_):
-        ind = kmeans.labels_ == i
-        Y_pred[ind] = Counter(Y[ind]).most_common(1)[0][0]  # assign label.
+    # Majority label of each cluster from a (cluster, label) histogram.
+    counts = np.zeros((n_clusters, Y.max() + 1), dtype=np.int64)
+    np.add.at(counts, (labels, Y), 1)
 
-    return Y_pred
+    return counts.argmax(axis=1)[labels]
 
 
 def plot(V: np.ndarray, img_size: Tuple[int, int]) -> None:
@@ -83,6 +143,11 @@ def plot(V: np.ndarray, img_size: Tuple[int, int]) -> None:
     plt.yticks(())
 
 
+def no_weight(X: np.ndarray, W: np.ndarray, H: np.ndarray) -> float:
+    """Uniform weight of plain NMF"""
+    return 1
+
+
 def nmf(K: int,
         X: np.ndarray,
         steps: int,
@@ -90,18 +155,44 @@ def nmf(K: int,
         l1: float = 0,
         l2: float = 0,
         weight: Callable[[np.ndarray, np.ndarray, np.ndarray],
-                         np.ndarray] = lambda x, w, h: 1,
-        tol: float = 1e-3) -> Tuple[np.ndarray, np.ndarray]:
-    """Generic NMF algorithm using multiplicative updates"""
-    avg = np.sqrt(X.mean() / K)
-    np.random.seed(0)
-    W, H = avg * np.random.rand(len(X), K), avg * np.random.rand(K, len(X[0]))
+                         np.ndarray] = no_weight,
+        tol: float = 1e-3,
+        backend: str = 'cpu',
+        method: str = 'mu') -> Tuple[np.ndarray, np.ndarray]:
+    """Generic NMF algorithm using multiplicative updates (or HALS)"""
+    if method not in ('mu', 'hals'):
+        raise ValueError(f'unknown method: {method}')
+
+    if method == 'hals' and (beta != 2 or weight is not no_weight):
+        raise ValueError('hals only supports unweighted NMF with beta=2')
+
+    if backend == 'cuda' and cupy is None:
+        raise ImportError('cupy is required for the cuda backend')
+
+    xp = cupy if backend == 'cuda' else np
+    # Single precision throughout; X stays resident on the device. X is
+    # row-major like the W @ H products it is combined with element-wise.
+    X = xp.asarray(X, dtype=xp.float32, order='C')
+    avg = np.sqrt(float(X.mean()) / K)
+    xp.random.seed(0)
+    W = xp.random.rand(len(X), K).astype(xp.float32)
+    H = xp.random.rand(K, len(X[0])).astype(xp.float32)
+    W *= avg
+    H *= avg
 
     for _ in range(steps):
-        W, H, done = mur(X, W, H, weight(X, W, H), beta, l1, l2, tol)
+        if method == 'hals':
+            W, H, done = hals(X, W, H, l1, l2, tol)
+        elif beta == 2:
+            W, H, done = mur_beta2(X, W, H, weight(X, W, H), l1, l2, tol)
+        else:
+            W, H, done = mur(X, W, H, weight(X, W, H), beta, l1, l2, tol)
         if done:
             break
 
+    if xp is not np:
+        W, H = cupy.asnumpy(W), cupy.asnumpy(H)
+
     return W, H
 
 
@@ -109,22 +200,77 @@ def mur(X: np.ndarray, W: np.ndarray, H: np.ndarray, U: np.ndarray,
         beta: float, l1: float, l2: float,
         tol: float) -> Tuple[np.ndarray, np.ndarray, bool]:
     """Weighted multiplicative update rule"""
-    WH = W @ H
-    d_W = U * X * WH**(beta - 2) @ H.T / (U * WH**(beta - 1) @ H.T + l1 +
-                                          l2 * W)
+    A, B = mu_terms(X, U, W @ H, beta)
+    d_W = A @ H.T / (B @ H.T + l1 + l2 * W)
     e_W = np.linalg.norm(W * (1 - d_W))
     W *= d_W
-    WH = W @ H
-    d_H = W.T @ (U * X * WH**(beta - 2)) / (W.T @ (U * WH**(beta - 1)) + l1 +
-                                            l2 * H)
+    A, B = mu_terms(X, U, W @ H, beta)
+    d_H = W.T @ A / (W.T @ B + l1 + l2 * H)
     H *= d_H
     e_H = np.linalg.norm(H * (1 - d_H))
     return W, H, e_W < tol and e_H < tol
 
 
+def mur_beta2(X: np.ndarray, W: np.ndarray, H: np.ndarray, U: np.ndarray,
+              l1: float, l2: float,
+              tol: float) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Weighted multiplicative update rule for the Frobenius norm (beta=2)"""
+    if np.ndim(U) == 0:
+        # Uniform weight: contract the K x K Gram matrices instead of WH.
+        d_W = U * (X @ H.T) / (U * (W @ (H @ H.T)) + l1 + l2 * W)
+        e_W = np.linalg.norm(W * (1 - d_W))
+        W *= d_W
+        d_H = U * (W.T @ X) / (U * ((W.T @ W) @ H) + l1 + l2 * H)
+        H *= d_H
+        e_H = np.linalg.norm(H * (1 - d_H))
+        return W, H, e_W < tol and e_H < tol
+
+    UX = U * X  # same weight for both half-steps.
+    UWH = W @ H
+    UWH *= U
+    d_W = UX @ H.T / (UWH @ H.T + l1 + l2 * W)
+    e_W = np.linalg.norm(W * (1 - d_W))
+    W *= d_W
+    UWH = np.matmul(W, H, out=UWH)
+    UWH *= U
+    d_H = W.T @ UX / (W.T @ UWH + l1 + l2 * H)
+    H *= d_H
+    e_H = np.linalg.norm(H * (1 - d_H))
+    return W, H, e_W < tol and e_H < tol
+
+
+def hals(X: np.ndarray, W: np.ndarray, H: np.ndarray, l1: float, l2: float,
+         tol: float) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Hierarchical alternating least squares (rank-one updates, beta=2)"""
+    XHt, HHt = X @ H.T, H @ H.T
+    W_old = W.copy()
+
+    for r in range(W.shape[1]):
+        num = XHt[:, r] - W @ HHt[:, r] + W[:, r] * HHt[r, r] - l1
+        W[:, r] = np.maximum(num / (HHt[r, r] + l2), 1e-10)
+
+    e_W = np.linalg.norm(W - W_old)
+    WtX, WtW = W.T @ X, W.T @ W
+    H_old = H.copy()
+
+    for r in range(H.shape[0]):
+        num = WtX[r] - WtW[r] @ H + WtW[r, r] * H[r] - l1
+        H[r] = np.maximum(num / (WtW[r, r] + l2), 1e-10)
+
+    e_H = np.linalg.norm(H - H_old)
+    return W, H, e_W < tol and e_H < tol
+
+
+def mu_terms(X: np.ndarray, U: np.ndarray, WH: np.ndarray,
+             beta: float) -> Tuple[np.ndarray, np.ndarray]:
+    """U * X * WH**(beta - 2) and U * WH**(beta - 1)"""
+    return U * X * WH**(beta - 2), U * WH**(beta - 1)
+
+
 def err(X: np.ndarray, W: np.ndarray, H: np.ndarray) -> np.ndarray:
     """Difference between the original and the reconstructed"""
-    return X - W @ H
+    E = W @ H
+    return np.subtract(X, E, out=E)
 
 
 def tanh_weight(X: np.ndarray,
@@ -133,14 +279,24 @@ def tanh_weight(X: np.ndarray,
                 p: float = 1) -> np.ndarray:
     """Weight calculation for tanhNMF"""
     E = err(X, W, H)
-    a = X.size * p / (E**2).sum()
-    return a * (1 - np.tanh(a * np.abs(E))**2)
+    a = X.size * p / np.vdot(E, E)
+
+    # a * (1 - tanh(a * |E|)**2), computed in place in E.
+    np.abs(E, out=E)
+    E *= a
+    np.tanh(E, out=E)
+    E *= E
+    np.subtract(1, E, out=E)
+    E *= a
+    return E
 
 
 def cim_weight(X: np.ndarray, W: np.ndarray, H: np.ndarray) -> np.ndarray:
     """Weight calculation for CIM NMF"""
-    E2 = err(X, W, H)**2
-    return np.exp(-E2 / E2.mean())
+    E2 = err(X, W, H)
+    E2 *= E2
+    E2 *= -1 / E2.mean()
+    return np.exp(E2, out=E2)
 
 
 def l1_weight(X: np.ndarray, W: np.ndarray, H: np.ndarray) -> np.ndarray:
@@ -153,78 +309,138 @@ def l21_weight(X: np.ndarray, W: np.ndarray, H: np.ndarray) -> np.ndarray:
     return 1 / np.linalg.norm(err(X, W, H), axis=0)
 
 
-def tanh_nmf(K: int, X: np.ndarray,
-             steps: int) -> Tuple[np.ndarray, np.ndarray]:
+def tanh_nmf(K: int,
+             X: np.ndarray,
+             steps: int,
+             backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
     """Another Robust NMF"""
-    return nmf(K, X, steps, weight=tanh_weight)
+    return nmf(K, X, steps, weight=tanh_weight, backend=backend)
 
 
-def cim_nmf(K: int, X: np.ndarray,
-            steps: int) -> Tuple[np.ndarray, np.ndarray]:
+def cim_nmf(K: int,
+            X: np.ndarray,
+            steps: int,
+            backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
     """Robust NMF via half-quadratic minimization"""
-    return nmf(K, X, steps, weight=cim_weight)
+    return nmf(K, X, steps, weight=cim_weight, backend=backend)
 
 
-def l21_nmf(K: int, X: np.ndarray,
-            steps: int) -> Tuple[np.ndarray, np.ndarray]:
+def l21_nmf(K: int,
+            X: np.ndarray,
+            steps: int,
+            backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
     """Robust nonnegative matrix factorization using l21-norm"""
-    return nmf(K, X, steps, weight=l21_weight)
+    return nmf(K, X, steps, weight=l21_weight, backend=backend)
 
 
-def l1_nmf(K: int, X: np.ndarray, steps: int) -> Tuple[np.ndarray, np.ndarray]:
+def l1_nmf(K: int,
+           X: np.ndarray,
+           steps: int,
+           backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
     """“Non-negative Matrix Factorization for Images with Laplacian Noise"""
-    return nmf(K, X, steps, weight=l1_weight)
+    return nmf(K, X, steps, weight=l1_weight, backend=backend)
 
 
-def kl_nmf(K: int, X: np.ndarray, steps: int) -> Tuple[np.ndarray, np.ndarray]:
+def hals_nmf(K: int,
+             X: np.ndarray,
+             steps: int,
+             backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
+    """Fast local algorithms for large scale NMF (HALS)"""
+    return nmf(K, X, steps, backend=backend, method='hals')
+
+
+def kl_nmf(K: int,
+           X: np.ndarray,
+           steps: int,
+           backend: str = 'cpu') -> Tuple[np.ndarray, np.ndarray]:
     """Algorithms for nonnegative matrix factorization with the β-divergence"""
-    return nmf(K, X, steps, beta=1)
+    return nmf(K, X, steps, beta=1, backend=backend)
 
 
-def no_noise(shape: Tuple[int, int], scale: float) -> float:
+def no_noise(rng: np.random.Generator, shape: Tuple[int, int],
+             scale: float) -> float:
     """No noise"""
     return 0
 
 
-def salt_and_pepper(shape: Tuple[int, int],
+def salt_and_pepper(rng: np.random.Generator,
+                    shape: Tuple[int, int],
                     p: float = 0.4,
                     r: float = 0.3) -> np.ndarray:
     """Randomly change some pixels to black or white"""
-    p_noise = np.random.rand(*shape) <= p
-    r_noise = np.random.rand(*shape) <= r
-    return 1 * (p_noise * r_noise) - 1 * (p_noise * ~r_noise)
+    # One draw: u <= p * r is white, p * r < u <= p is black.
+    u = rng.random(shape, dtype=np.float32)
+    noise = np.zeros(shape, dtype=np.float32)
+    np.copyto(noise, -1, where=u <= p)
+    np.copyto(noise, 1, where=u <= p * r)
+    return noise
 
 
-def uniform(shape: Tuple[int, int], scale: float = 0.1) -> np.ndarray:
+def uniform(rng: np.random.Generator,
+            shape: Tuple[int, int],
+            scale: float = 0.1) -> np.ndarray:
     """Uniform noise"""
-    return scale * (np.random.rand(*shape) - 0.5)
+    noise = rng.random(shape, dtype=np.float32)
+    noise -= 0.5
+    noise *= scale
+    return noise
 
 
-def laplace(shape: Tuple[int, int], scale: float = 0.1) -> np.ndarray:
+def laplace(rng: np.random.Generator,
+            shape: Tuple[int, int],
+            scale: float = 0.1) -> np.ndarray:
     """Laplace noise"""
-    return np.random.laplace(scale=scale)
+    return rng.laplace(scale=scale, size=shape).astype(np.float32)
 
 
-def gaussian(shape: Tuple[int, int], scale: float = 0.1) -> np.ndarray:
+def gaussian(rng: np.random.Generator,
+             shape: Tuple[int, int],
+             scale: float = 0.1) -> np.ndarray:
     """Gaussian noise"""
-    return np.random.normal(scale=scale)
+    noise = rng.standard_normal(shape, dtype=np.float32)
+    noise *= scale
+    return noise
 
 
 def evaluate_algorithm(
-        V: np.ndarray, V_hat: np.ndarray, Y_hat: np.ndarray, algorithm: str,
-        steps: int) -> Tuple[float, float, float, np.ndarray, np.ndarray]:
+    V: np.ndarray,
+    V_hat: np.ndarray,
+    Y_hat: np.ndarray,
+    n_classes: int,
+    algorithm: str,
+    steps: int,
+    backend: str = 'cpu',
+    norm2: Optional[float] = None,
+    clusterer: str = 'sklearn'
+) -> Tuple[float, float, float, np.ndarray, np.ndarray]:
     """Fit model and run evaluation metrics"""
-    W, H = ALGORITHMS[algorithm](len(set(Y_hat)), V, steps)
+    W, H = ALGORITHMS[algorithm](n_classes, V, steps, backend=backend)
 
     # Assign cluster labels.
-    Y_pred = assign_cluster_label(H.T, Y_hat)
+    Y_pred = assign_cluster_label(H.T, Y_hat, n_classes, clusterer)
+
+    if norm2 is None:
+        norm2 = sq_norm(V_hat)
 
-    rre = np.linalg.norm(V_hat - W @ H) / np.linalg.norm(V_hat)
+    rre = np.linalg.norm(V_hat - W @ H) / np.sqrt(norm2)
     acc = accuracy_score(Y_hat, Y_pred)
     nmi = normalized_mutual_info_score(Y_hat, Y_pred)
     return rre, acc, nmi, W, H
 
 
+def evaluate_trial(
+    args: Tuple[np.ndarray, np.ndarray, np.ndarray, int, str, int, str, float,
+                str]
+) -> Tuple[float, float, float, np.ndarray, np.ndarray]:
+    """Single-argument evaluate_algorithm, for Pool.imap"""
+    return evaluate_algorithm(*args)
+
+
+def sq_norm(X: np.ndarray) -> float:
+    """Squared Frobenius norm, accumulated in double precision"""
+    return float(np.einsum('ij,ij->', X, X, dtype=np.float64))
+
+
 def graph(figures: str, algorithms: List[str]) -> None:
     """Read summary results and output graphs and latex tables"""
     data = {}
@@ -246,8 +462,10 @@ def graph(figures: str, algorithms: List[str]) -> None:
         for i, measure in enumerate(MEASURES, 1):
             plt.subplot(1, len(MEASURES), i)
             print(
-                TABLE_START.format(' & '.join(
-                    (a.replace('_', '-') for a in algorithms))))
+                TABLE_START.format(cols='c' * len(algorithms),
+                                   names=' & '.join(
+                                       (a.replace('_', '-')
+                                        for a in algorithms))))
             first = list(d.values())[0]
 
             for i, r in enumerate(first):
@@ -283,97 +501,137 @@ def figure() -> None:
     plt.figure(figsize=(10, 3))
 
 
+def init_worker(threads: int) -> None:
+    """Limit BLAS threads so parallel trials do not oversubscribe cores"""
+    threadpool_limits(threads)
+
+
 def run_nmf_algorithms(results: TextIO, algorithms: List[str],
                        noises: List[str], trials: int, figures: str, data: str,
-                       datasets: List[str], steps: int) -> None:
+                       datasets: List[str], steps: int, backend: str,
+                       clusterer: str) -> None:
     """Run all combinations of algorithms and data and record results"""
-    header = ['dataset', 'noise', 'noiselevel', 'algorithm'] + MEASURES
+    header = ['dataset', 'noise', 'noiselevel', 'clusterer', 'algorithm'
+              ] + MEASURES
     w_summary = DictWriter(stdout, header + [f'{x}_std' for x in MEASURES])
     w_summary.writeheader()
     w = DictWriter(results, header + ['trial'])
     w.writeheader()
     Y_hats = [None] * trials
-    V_hats, Vs = Y_hats.copy(), Y_hats.copy()
-    rre = np.zeros(len(Y_hats))
-    acc, nmi = rre.copy(), rre.copy()
-
-    for dataset in datasets:
-        np.random.seed(0)
-        red, imgsize = DATASETS[dataset]
-
-        # Load dataset.
-        V_hat_orig, Y_hat_orig = load_data(f'{data}/{dataset}', red)
-        img_size = [i // red for i in imgsize]
-
-        for i in range(len(Y_hats)):
-            V_hats[i], _, Y_hats[i], _ = train_test_split(V_hat_orig.T,
-                                                          Y_hat_orig,
-                                                          train_size=0.9)
-            V_hats[i] = V_hats[i].T
-
-        for noise, noise_fn, k, p in ((noise, NOISES[noise][0], k, p)
-                                      for noise in noises
-                                      for k, p in enumerate(NOISES[noise][1])):
-            row = {'dataset': dataset, 'noise': noise, 'noiselevel': p}
-
-            # Add Noise
-            np.random.seed(0)
-            Vs = [np.clip(v + noise_fn(v.shape, p), 1e-7, 1) for v in V_hats]
-
-            if figures:
-                figure()
-
-                for i, (v, v_hat) in enumerate(zip(Vs, V_hats)):
-                    imgs = ((v_hat, 'original'), (v, 'with noise'))
-
-                    for j, (img, title) in enumerate(imgs, 1):
-                        plt.subplot(trials,
-                                    len(algorithms) + 2,
-                                    (len(algorithms) + 2) * i + j)
-                        plot(img, img_size)
+    V_hats = Y_hats.copy()
 
-                        if i == 0:
-                            plt.title(title)
+    processes = min(trials, os.cpu_count() or 1)
+    threads = max(1, (os.cpu_count() or 1) // max(1, processes))
 
-            for a, algorithm in enumerate(algorithms, 1):
-                row['algorithm'] = algorithm
+    # A single trial (or core) runs in-process, without spawning workers.
+    with (get_context('spawn').Pool(processes, init_worker, (threads, ))
+          if processes > 1 else nullcontext()) as pool:
+        imap = map if pool is None else pool.imap
 
-                for i, (V, V_hat, Y_hat) in enumerate(zip(Vs, V_hats, Y_hats)):
-                    rre[i], acc[i], nmi[i], W, H = evaluate_algorithm(
-                        V, V_hat, Y_hat, algorithm, steps)
-
-                    if figures:
-                        plt.subplot(trials,
-                                    len(algorithms) + 2,
-                                    (len(algorithms) + 2) * i + a + 2)
-                        plot(W @ H, img_size)
-
-                        if i == 0:
-                            plt.title(row['algorithm'])
-
-                    w.writerow({
+        for dataset in datasets:
+            np.random.seed(0)
+            red, imgsize = DATASETS[dataset]
+
+            # Load dataset.
+            V_hat_orig, Y_hat_orig = load_data(f'{data}/{dataset}', red)
+            img_size = [i // red for i in imgsize]
+            n_classes = len(np.unique(Y_hat_orig))
+
+            for i in range(len(Y_hats)):
+                V_hats[i], _, Y_hats[i], _ = train_test_split(
+                    V_hat_orig.T, Y_hat_orig, train_size=0.9)
+
+                # Scale the 8-bit pixels to [0, 1] once per split.
+                V_hats[i] = V_hats[i].T * np.float32(1 / SCALE)
+
+            # Shared by the reconstruction error of every algorithm.
+            norms2 = [sq_norm(v) for v in V_hats]
+
+            # Noisy copies are rewritten in place for every noise level.
+            Vs = [np.empty_like(v) for v in V_hats]
+
+            for noise, noise_fn, k, p in (
+                (noise, NOISES[noise][0], k, p) for noise in noises
+                    for k, p in enumerate(NOISES[noise][1])):
+                row = {
+                    'dataset': dataset,
+                    'noise': noise,
+                    'noiselevel': p,
+                    'clusterer': clusterer
+                }
+
+                # Add Noise
+                rng = np.random.default_rng(0)
+
+                for v, v_hat in zip(Vs, V_hats):
+                    np.add(v_hat, noise_fn(rng, v_hat.shape, p), out=v)
+                    np.clip(v, 1e-7, 1, out=v)
+
+                if figures:
+                    figure()
+
+                    for i, (v, v_hat) in enumerate(zip(Vs, V_hats)):
+                        imgs = ((v_hat, 'original'), (v, 'with noise'))
+
+                        for j, (img, title) in enumerate(imgs, 1):
+                            plt.subplot(trials,
+                                        len(algorithms) + 2,
+                                        (len(algorithms) + 2) * i + j)
+                            plot(img, img_size)
+
+                            if i == 0:
+                                plt.title(title)
+
+                for a, algorithm in enumerate(algorithms, 1):
+                    row['algorithm'] = algorithm
+
+                    # Trials are independent, evaluate them in parallel.
+                    outcomes = imap(
+                        evaluate_trial,
+                        [(V, V_hat, Y_hat, n_classes, algorithm, steps,
+                          backend, norm2, clusterer)
+                         for V, V_hat, Y_hat, norm2 in zip(
+                             Vs, V_hats, Y_hats, norms2)])
+
+                    # Running mean and variance (Welford) of the measures.
+                    count, mean = 0, np.zeros(len(MEASURES))
+                    m2 = mean.copy()
+
+                    for i, (*scores, W, H) in enumerate(outcomes):
+                        count += 1
+                        delta = scores - mean
+                        mean += delta / count
+                        m2 += delta * (scores - mean)
+
+                        if figures:
+                            plt.subplot(trials,
+                                        len(algorithms) + 2,
+                                        (len(algorithms) + 2) * i + a + 2)
+                            plot(W @ H, img_size)
+
+                            if i == 0:
+                                plt.title(row['algorithm'])
+
+                        w.writerow({
+                            **row,
+                            'trial': i + 1,
+                            **dict(zip(MEASURES, scores)),
+                        })
+
+                    std = np.sqrt(m2 / count)
+                    w_summary.writerow({
                         **row,
-                        'trial': i + 1,
-                        'RRE': rre[i],
-                        'Acc': acc[i],
-                        'NMI': nmi[i],
+                        **{x: '{:.4f}'.format(v)
+                           for x, v in zip(MEASURES, mean)},
+                        **{f'{x}_std': '{:.4f}'.format(v)
+                           for x, v in zip(MEASURES, std)},
                     })
 
-                w_summary.writerow({
-                    **row,
-                    'RRE': '{:.4f}'.format(rre.mean()),
-                    'RRE_std': '{:.4f}'.format(rre.std()),
-                    'Acc': '{:.4f}'.format(acc.mean()),
-                    'Acc_std': '{:.4f}'.format(acc.std()),
-                    'NMI': '{:.4f}'.format(nmi.mean()),
-                    'NMI_std': '{:.4f}'.format(nmi.std()),
-                })
-
-            if figures:
-                plt.subplots_adjust(wspace=0, hspace=0)
-                plt.savefig(f'{figures}/{dataset}-{noise}-{k}.png',
-                            bbox_inches='tight',
-                            pad_inches=0)
+                if figures:
+                    plt.subplots_adjust(wspace=0, hspace=0)
+                    plt.savefig(f'{figures}/{dataset}-{noise}-{k}.png',
+                                bbox_inches='tight',
+                                pad_inches=0)
 
 
 def main() -> None:
@@ -395,6 +653,16 @@ def main() -> None:
                         type=int,
                         default=100,
                         help='number of multiplicative updates')
+    parser.add_argument('-b',
+                        '--backend',
+                        choices=['cpu', 'cuda'],
+                        default='cpu',
+                        help='array backend for the updates (cuda needs cupy)')
+    parser.add_argument('-c',
+                        '--clusterer',
+                        choices=['sklearn', 'faiss'],
+                        default='sklearn',
+                        help='k-means used to label H (faiss needs faiss)')
     parser.add_argument(
         '-n',
         '--noises',
@@ -423,6 +691,9 @@ def main() -> None:
         help='read results from stdin and generate graphs and latex tables')
     args = parser.parse_args()
 
+    if args.trials < 1:
+        parser.error('--trials must be at least 1')
+
     if args.figures:
         Path(args.figures).mkdir(parents=True, exist_ok=True)
 
@@ -430,9 +701,10 @@ def main() -> None:
         graph(args.figures, args.algorithms)
         return
 
-    with open(args.reesults or os.devnulll, 'w') as r:
+    with open(args.results or os.devnull, 'w') as r:
         run_nmf_algorithms(r, args.algorithms, args.noises, args.trials,
-                           args.figures, args.data, args.datasets, args.steps)
+                           args.figures, args.data, args.datasets, args.steps,
+                           args.backend, args.clusterer)
 
 
 SCALE = 255
@@ -442,7 +714,8 @@ ALGORITHMS = {
     'l1_nmf': l1_nmf,
     'l21_nmf': l21_nmf,
     'cim_nmf': cim_nmf,
-    'tanh_nmf': tanh_nmf
+    'tanh_nmf': tanh_nmf,
+    'hals_nmf': hals_nmf
 }
 DATASETS = {'ORL': (3, (92, 112)), 'CroppedYaleB': (4, (168, 192))}
 NOISES = {
@@ -454,7 +727,7 @@ NOISES = {
 }
 MEASURES = ['RRE', 'Acc', 'NMI']
 TABLE_START = """\\begin{{table}}[H]
-\\begin{{tabular}}{{c|cccccc}}$\\sigma$ & {} \\\\\\hline"""
+\\begin{{tabular}}{{c|{cols}}}$\\sigma$ & {names} \\\\\\hline"""
 TABLE_END = """\\end{{tabular}}\\caption{{
   {measure}(\\%) on {dataset} dataset with {noise} noise (mean $\\pm$ std)
   \\label{{tab:{measure}-{dataset}-{noise}}}